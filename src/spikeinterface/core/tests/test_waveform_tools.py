@@ -1,6 +1,5 @@
 import pytest
 from pathlib import Path
-import shutil
 import platform
 
 import numpy as np
@@ -21,11 +20,21 @@ else:
     cache_folder = Path("cache_folder") / "core"
 
 
+def _concatenate_wfs(wfs_arrays, unit_ids):
+    shapes = [wfs_arrays[unit_id].shape for unit_id in unit_ids]
+    all_wfs = np.concatenate([wfs_arrays[unit_id].ravel() for unit_id in unit_ids])
+    return shapes, all_wfs
+
+
 def _check_all_wf_equal(list_wfs_arrays):
-    wfs_arrays0 = list_wfs_arrays[0]
-    for i, wfs_arrays in enumerate(list_wfs_arrays):
-        for unit_id in wfs_arrays.keys():
-            assert np.array_equal(wfs_arrays[unit_id], wfs_arrays0[unit_id])
+    # compare all units at once for each replicate
+    unit_ids = list(list_wfs_arrays[0].keys())
+    shapes0, all_wfs0 = _concatenate_wfs(list_wfs_arrays[0], unit_ids)
+    for wfs_arrays in list_wfs_arrays[1:]:
+        assert list(wfs_arrays.keys()) == unit_ids
+        shapes, all_wfs = _concatenate_wfs(wfs_arrays, unit_ids)
+        assert shapes == shapes0
+        assert np.array_equal(all_wfs, all_wfs0)
 
 
 def get_dataset():
@@ -41,24 +50,76 @@ def get_dataset():
     return recording, sorting
 
 
-def test_waveform_tools():
-    # durations = [30, 40]
-    # sampling_frequency = 30000.0
+some_job_kwargs = [
+    {"n_jobs": 1, "chunk_size": 3000, "progress_bar": True},
+    {"n_jobs": 2, "chunk_size": 3000, "progress_bar": True},
+]
+some_modes = [
+    {"mode": "memmap"},
+    {"mode": "shared_memory"},
+]
+# if platform.system() != "Windows":
+#     # shared memory on windows is buggy...
+#     some_modes.append(
+#         {
+#             "mode": "shared_memory",
+#         }
+#     )
+
+
+def get_sparsity_mask(recording, sorting):
+    # seeded so that the mask (and so the extracted waveforms) is the same at every run
+    rng = np.random.default_rng(42)
+    return rng.integers(0, 2, size=(sorting.unit_ids.size, recording.channel_ids.size), dtype="bool")
+
+
+@pytest.fixture(name="dataset", scope="session")
+def dataset_fixture(tmp_path_factory):
+    # generate once per session and save to disk, so that all tests read the traces from a memmap
+    recording, sorting = get_dataset()
+    folder = tmp_path_factory.mktemp("waveform_tools_dataset")
+    recording = recording.save(folder=folder / "recording")
+    sorting = sorting.save(folder=folder / "sorting")
+    return recording, sorting
+
 
-    # # 2 segments
-    # num_channels = 2
-    # recording = generate_recording(
-    #     num_channels=num_channels, durations=durations, sampling_frequency=sampling_frequency
-    # )
-    # recording.annotate(is_filtered=True)
-    # num_units = 15
-    # sorting = generate_sorting(num_units=num_units, sampling_frequency=sampling_frequency, durations=durations)
+@pytest.fixture(name="sparsity_mask", scope="module")
+def sparsity_mask_fixture(dataset):
+    recording, sorting = dataset
+    return get_sparsity_mask(recording, sorting)
 
-    # test with dump !!!!
-    # recording = recording.save()
-    # sorting = sorting.save()
 
-    recording, sorting = get_dataset()
+def get_reference_waveforms(recording, sorting, sparsity_mask):
+    # reference waveforms extracted in a single process, all combinations are compared to it
+    sampling_frequency = recording.sampling_frequency
+    nbefore = int(3.0 * sampling_frequency / 1000.0)
+    nafter = int(4.0 * sampling_frequency / 1000.0)
+    return extract_waveforms_to_buffers(
+        recording,
+        sorting.to_spike_vector(),
+        sorting.unit_ids,
+        nbefore,
+        nafter,
+        return_scaled=False,
+        dtype=recording.get_dtype(),
+        copy=True,
+        sparsity_mask=sparsity_mask,
+        mode="shared_memory",
+        n_jobs=1,
+        chunk_size=3000,
+    )
+
+
+@pytest.fixture(name="reference_waveforms", scope="module")
+def reference_waveforms_fixture(dataset, sparsity_mask):
+    recording, sorting = dataset
+    return {
+        "dense": get_reference_waveforms(recording, sorting, None),
+        "sparse": get_reference_waveforms(recording, sorting, sparsity_mask),
+    }
+
+
+def run_waveform_tools(recording, sorting, job_kwargs, mode_kwargs, sparsity_mask, folder):
     sampling_frequency = recording.sampling_frequency
 
     nbefore = int(3.0 * sampling_frequency / 1000.0)
@@ -71,100 +132,72 @@ def test_waveform_tools():
 
     unit_ids = sorting.unit_ids
 
-    some_job_kwargs = [
-        {"n_jobs": 1, "chunk_size": 3000, "progress_bar": True},
-        {"n_jobs": 2, "chunk_size": 3000, "progress_bar": True},
-    ]
-    some_modes = [
-        {"mode": "memmap"},
-        {"mode": "shared_memory"},
-    ]
-    # if platform.system() != "Windows":
-    #     # shared memory on windows is buggy...
-    #     some_modes.append(
-    #         {
-    #             "mode": "shared_memory",
-    #         }
-    #     )
-
-    some_sparsity = [
-        dict(sparsity_mask=None),
-        dict(sparsity_mask=np.random.randint(0, 2, size=(unit_ids.size, recording.channel_ids.size), dtype="bool")),
-    ]
-
-    # memmap mode
-    list_wfs_dense = []
-    list_wfs_sparse = []
-    for j, job_kwargs in enumerate(some_job_kwargs):
-        for k, mode_kwargs in enumerate(some_modes):
-            for l, sparsity_kwargs in enumerate(some_sparsity):
-                # print()
-                # print(job_kwargs, mode_kwargs, 'sparse=', sparsity_kwargs['sparsity_mask'] is None)
-
-                if mode_kwargs["mode"] == "memmap":
-                    wf_folder = cache_folder / f"test_waveform_tools_{j}_{k}_{l}"
-                    if wf_folder.is_dir():
-                        shutil.rmtree(wf_folder)
-                    wf_folder.mkdir(parents=True)
-                    wf_file_path = wf_folder / "waveforms_all_units.npy"
-
-                mode_kwargs_ = dict(**mode_kwargs)
-                if mode_kwargs["mode"] == "memmap":
-                    mode_kwargs_["folder"] = wf_folder
-
-                wfs_arrays = extract_waveforms_to_buffers(
-                    recording,
-                    spikes,
-                    unit_ids,
-                    nbefore,
-                    nafter,
-                    return_scaled=False,
-                    dtype=dtype,
-                    copy=True,
-                    **sparsity_kwargs,
-                    **mode_kwargs_,
-                    **job_kwargs,
-                )
-                for unit_ind, unit_id in enumerate(unit_ids):
-                    wf = wfs_arrays[unit_id]
-                    assert wf.shape[0] == np.sum(spikes["unit_index"] == unit_ind)
-
-                if sparsity_kwargs["sparsity_mask"] is None:
-                    list_wfs_dense.append(wfs_arrays)
-                else:
-                    list_wfs_sparse.append(wfs_arrays)
-
-                mode_kwargs_ = dict(**mode_kwargs)
-                if mode_kwargs["mode"] == "memmap":
-                    mode_kwargs_["file_path"] = wf_file_path
-
-                all_waveforms = extract_waveforms_to_single_buffer(
-                    recording,
-                    spikes,
-                    unit_ids,
-                    nbefore,
-                    nafter,
-                    return_scaled=False,
-                    dtype=dtype,
-                    copy=True,
-                    **sparsity_kwargs,
-                    **mode_kwargs_,
-                    **job_kwargs,
-                )
-                wfs_arrays = split_waveforms_by_units(
-                    unit_ids, spikes, all_waveforms, sparsity_mask=sparsity_kwargs["sparsity_mask"]
-                )
-                if sparsity_kwargs["sparsity_mask"] is None:
-                    list_wfs_dense.append(wfs_arrays)
-                else:
-                    list_wfs_sparse.append(wfs_arrays)
+    list_wfs = []
+
+    if mode_kwargs["mode"] == "memmap":
+        wf_folder = folder / "waveforms"
+        wf_folder.mkdir(parents=True, exist_ok=True)
+        wf_file_path = wf_folder / "waveforms_all_units.npy"
+
+    mode_kwargs_ = dict(**mode_kwargs)
+    if mode_kwargs["mode"] == "memmap":
+        mode_kwargs_["folder"] = wf_folder
+
+    wfs_arrays = extract_waveforms_to_buffers(
+        recording,
+        spikes,
+        unit_ids,
+        nbefore,
+        nafter,
+        return_scaled=False,
+        dtype=dtype,
+        copy=True,
+        sparsity_mask=sparsity_mask,
+        **mode_kwargs_,
+        **job_kwargs,
+    )
+    for unit_ind, unit_id in enumerate(unit_ids):
+        wf = wfs_arrays[unit_id]
+        assert wf.shape[0] == np.sum(spikes["unit_index"] == unit_ind)
+    list_wfs.append(wfs_arrays)
+
+    mode_kwargs_ = dict(**mode_kwargs)
+    if mode_kwargs["mode"] == "memmap":
+        mode_kwargs_["file_path"] = wf_file_path
+
+    all_waveforms = extract_waveforms_to_single_buffer(
+        recording,
+        spikes,
+        unit_ids,
+        nbefore,
+        nafter,
+        return_scaled=False,
+        dtype=dtype,
+        copy=True,
+        sparsity_mask=sparsity_mask,
+        **mode_kwargs_,
+        **job_kwargs,
+    )
+    wfs_arrays = split_waveforms_by_units(unit_ids, spikes, all_waveforms, sparsity_mask=sparsity_mask)
+    list_wfs.append(wfs_arrays)
 
-    _check_all_wf_equal(list_wfs_dense)
-    _check_all_wf_equal(list_wfs_sparse)
+    return list_wfs
 
 
-def test_estimate_templates_with_accumulator():
-    recording, sorting = get_dataset()
+@pytest.mark.parametrize("job_kwargs", some_job_kwargs, ids=lambda job_kwargs: f"n_jobs={job_kwargs['n_jobs']}")
+@pytest.mark.parametrize("mode_kwargs", some_modes, ids=lambda mode_kwargs: mode_kwargs["mode"])
+@pytest.mark.parametrize("sparse", [False, True], ids=["dense", "sparse"])
+def test_waveform_tools(dataset, sparsity_mask, reference_waveforms, job_kwargs, mode_kwargs, sparse, tmp_path):
+    recording, sorting = dataset
+    list_wfs = run_waveform_tools(
+        recording, sorting, job_kwargs, mode_kwargs, sparsity_mask if sparse else None, tmp_path
+    )
+    reference = reference_waveforms["sparse" if sparse else "dense"]
+    _check_all_wf_equal([reference] + list_wfs)
+
+
+def test_estimate_templates_with_accumulator(dataset):
+    recording, sorting = dataset
 
     ms_before = 1.0
     ms_after = 1.5
@@ -195,8 +228,8 @@ def test_estimate_templates_with_accumulator():
     # plt.show()
 
 
-def test_estimate_templates():
-    recording, sorting = get_dataset()
+def test_estimate_templates(dataset):
+    recording, sorting = dataset
 
     ms_before = 1.0
     ms_after = 1.5
@@ -230,6 +263,18 @@ def test_estimate_templates():
 
 
 if __name__ == "__main__":
-    test_waveform_tools()
-    test_estimate_templates_with_accumulator()
-    test_estimate_templates()
+    recording, sorting = get_dataset()
+    sparsity_mask = get_sparsity_mask(recording, sorting)
+    reference_waveforms = {
+        "dense": get_reference_waveforms(recording, sorting, None),
+        "sparse": get_reference_waveforms(recording, sorting, sparsity_mask),
+    }
+    for j, job_kwargs in enumerate(some_job_kwargs):
+        for k, mode_kwargs in enumerate(some_modes):
+            for l, sparse in enumerate((False, True)):
+                folder = cache_folder / f"test_waveform_tools_{j}_{k}_{l}"
+                test_waveform_tools(
+                    (recording, sorting), sparsity_mask, reference_waveforms, job_kwargs, mode_kwargs, sparse, folder
+                )
+    test_estimate_templates_with_accumulator((recording, sorting))
+    test_estimate_templates((recording, sorting))
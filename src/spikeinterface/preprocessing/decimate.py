@@ -1,22 +1,24 @@
 from __future__ import annotations
 
+import operator
+
 import numpy as np
 from spikeinterface.core.core_tools import (
     define_function_from_class,
 )
 
 from .basepreprocessor import BasePreprocessor
-from .filter import fix_dtype
-from ..core import BaseRecordingSegment
+from ..core import BaseRecordingSegment, get_chunk_with_margin
 
 
 class DecimateRecording(BasePreprocessor):
     """
     Decimate the recording extractor traces using array slicing
 
-    Important: This uses simple array slicing for decimation rather than eg scipy.decimate.
+    Important: By default this uses simple array slicing for decimation rather than eg scipy.decimate.
     This might introduce aliasing, or skip across signal of interest.
-    Consider  spikeinterface.preprocessing.ResampleRecording for safe resampling.
+    Use `antialias=True` to low-pass filter the traces before decimation, or consider
+    spikeinterface.preprocessing.ResampleRecording for safe resampling.
 
     Parameters
     ----------
@@ -31,6 +33,26 @@ class DecimateRecording(BasePreprocessor):
         to ensure that the decimated recording has at least one frame. Consider combining DecimateRecording
         with FrameSliceRecording for fine control on the recording start and end frames.
         The same decimation offset is applied to all segments from the parent recording.
+    antialias : bool, default: False
+        If True, the parent traces are low-pass filtered with a linear-phase FIR filter (cutoff at the
+        decimated Nyquist frequency) before being decimated, using a polyphase implementation
+        (scipy.signal.upfirdn). Borders of the segments are zero-padded. Like the slicing path, the parent is
+        read by sub-windows (each one with a margin of about `num_taps / 2` frames on both sides), so that peak
+        memory does not scale with the decimation factor times the requested number of frames.
+    num_taps : int | None, default: None
+        Number of taps of the anti-aliasing FIR filter, must be odd. Only used if `antialias=True`.
+        If None, `16 * decimation_factor + 1` is used.
+    dtype : dtype or None, default: None
+        The dtype of the returned traces. If None, the dtype of the parent recording is used, except with
+        `antialias=True` where the dtype used for filtering, `np.result_type(parent_dtype, np.float32)`, is used
+        (float32 for float32 and 8/16-bit integer parents, float64 otherwise).
+        For an integer `dtype`, anti-aliased traces are rounded and clipped to the range of the dtype.
+    channel_major : bool, default: False
+        If True, `get_traces()` returns Fortran-ordered (channel-contiguous) arrays, so that the samples
+        of each channel are contiguous in memory. The shape is unchanged: (num_samples, num_channels).
+        This gives the same layout as `get_traces(order="F")`, but without its extra copy: decimation
+        already copies the parent traces, and this copy is directly made in Fortran order.
+        `get_traces(order=...)` can still be used per call to request another layout.
 
     Returns
     -------
@@ -48,14 +70,26 @@ class DecimateRecording(BasePreprocessor):
         recording,
         decimation_factor,
         decimation_offset=0,
+        antialias=False,
+        num_taps=None,
+        dtype=None,
+        channel_major=False,
     ):
         # Original sampling frequency
         self._orig_samp_freq = recording.get_sampling_frequency()
-        if not isinstance(decimation_factor, int) or decimation_factor <= 0:
+        try:
+            decimation_factor = operator.index(decimation_factor)
+        except TypeError:
+            raise ValueError(f"Expecting strictly positive integer for `decimation_factor` arg") from None
+        if decimation_factor <= 0:
             raise ValueError(f"Expecting strictly positive integer for `decimation_factor` arg")
         self._decimation_factor = decimation_factor
-        if not isinstance(decimation_offset, int) or decimation_factor < 0:
-            raise ValueError(f"Expecting positive integer for `decimation_factor` arg")
+        try:
+            decimation_offset = operator.index(decimation_offset)
+        except TypeError:
+            raise ValueError(f"Expecting non-negative integer for `decimation_offset` arg") from None
+        if decimation_offset < 0:
+            raise ValueError(f"Expecting non-negative integer for `decimation_offset` arg")
         parent_min_n_samp = min(
             [recording.get_num_samples(segment_index) for segment_index in range(recording.get_num_segments())]
         )
@@ -64,15 +98,56 @@ class DecimateRecording(BasePreprocessor):
                 f"Expecting `decimation_offset` < `decimation_factor` and `decimation_offset` < parent_segment.get_num_samples() for all segments. "
                 f"Consider combining DecimateRecording with FrameSliceRecording for fine control on the recording start/end frames."
             )
+
+        # Chained slicing decimations are collapsed into a single decimation of the grand-parent recording,
+        # which avoids reading and copying the intermediate decimated traces at each get_traces() call
+        decimated_recording = None
+        if (
+            isinstance(recording, DecimateRecording)
+            and not antialias
+            and not recording._kwargs["antialias"]
+            and recording.get_dtype() == recording._kwargs["recording"].get_dtype()
+        ):
+            decimated_recording = recording
+            recording = decimated_recording._kwargs["recording"]
+            decimation_offset = decimated_recording._decimation_offset + (
+                decimated_recording._decimation_factor * decimation_offset
+            )
+            decimation_factor = decimated_recording._decimation_factor * decimation_factor
+            self._orig_samp_freq = recording.get_sampling_frequency()
+            self._decimation_factor = decimation_factor
+
         self._decimation_offset = decimation_offset
         resample_rate = self._orig_samp_freq / self._decimation_factor
 
-        BasePreprocessor.__init__(self, recording, sampling_frequency=resample_rate)
+        fir_coeff = None
+        if antialias:
+            if num_taps is None:
+                num_taps = 16 * decimation_factor + 1
+            try:
+                num_taps = operator.index(num_taps)
+            except TypeError:
+                raise ValueError(f"Expecting strictly positive odd integer for `num_taps` arg") from None
+            if num_taps <= 0 or num_taps % 2 != 1:
+                raise ValueError(f"Expecting strictly positive odd integer for `num_taps` arg")
+            if decimation_factor > 1:
+                import scipy.signal
+
+                # filter in floating point, without losing the precision of float64 parents
+                filter_dtype = np.result_type(recording.get_dtype(), np.float32)
+                fir_coeff = scipy.signal.firwin(num_taps, 1.0 / decimation_factor).astype(filter_dtype)
+                if dtype is None:
+                    dtype = filter_dtype
+        if dtype is not None:
+            # make sure dtype is serializable
+            dtype = np.dtype(dtype).str
+
+        BasePreprocessor.__init__(self, recording, sampling_frequency=resample_rate, dtype=dtype)
+        if decimated_recording is not None:
+            # keep the metadata of the collapsed recording
+            decimated_recording.copy_metadata(self, only_main=False)
 
-        # in case there was a time_vector, it will be dropped for sanity.
-        # This is not necessary but consistent with ResampleRecording
         for parent_segment in recording._recording_segments:
-            parent_segment.time_vector = None
             self.add_recording_segment(
                 DecimateRecordingSegment(
                     parent_segment,
@@ -81,6 +156,9 @@ class DecimateRecording(BasePreprocessor):
                     decimation_factor,
                     decimation_offset,
                     self._dtype,
+                    recording.get_dtype(),
+                    fir_coeff,
+                    channel_major,
                 )
             )
 
@@ -88,10 +166,17 @@ class DecimateRecording(BasePreprocessor):
             recording=recording,
             decimation_factor=decimation_factor,
             decimation_offset=decimation_offset,
+            antialias=antialias,
+            num_taps=num_taps,
+            dtype=dtype,
+            channel_major=channel_major,
         )
 
 
 class DecimateRecordingSegment(BaseRecordingSegment):
+    # maximum number of parent frames read at once in get_traces()
+    _parent_chunk_size = 1 << 20
+
     def __init__(
         self,
         parent_recording_segment,
@@ -100,6 +185,9 @@ class DecimateRecordingSegment(BaseRecordingSegment):
         decimation_factor,
         decimation_offset,
         dtype,
+        parent_dtype,
+        fir_coeff=None,
+        channel_major=False,
     ):
         if parent_recording_segment.t_start is None:
             new_t_start = None
@@ -107,20 +195,28 @@ class DecimateRecordingSegment(BaseRecordingSegment):
             new_t_start = parent_recording_segment.t_start + decimation_offset / parent_rate
 
         # Do not use BasePreprocessorSegment bcause we have to reset the sampling rate!
+        # In case the parent has a time_vector, it is not propagated (consistent with ResampleRecording),
+        # but the parent segment is left untouched.
         BaseRecordingSegment.__init__(
             self,
             sampling_frequency=resample_rate,
             t_start=new_t_start,
+            time_vector=None,
         )
         self._parent_segment = parent_recording_segment
         self._decimation_factor = decimation_factor
         self._decimation_offset = decimation_offset
         self._dtype = dtype
+        self._dtype_matches_parent = np.dtype(dtype) == np.dtype(parent_dtype)
+        self._fir_coeff = fir_coeff
+        self._order = "F" if channel_major else "C"
+
+        parent_n_samp = parent_recording_segment.get_num_samples()
+        assert decimation_offset < parent_n_samp  # Sanity check (already enforced). Formula changes otherwise
+        self._num_samples = (parent_n_samp - decimation_offset + decimation_factor - 1) // decimation_factor
 
     def get_num_samples(self):
-        parent_n_samp = self._parent_segment.get_num_samples()
-        assert self._decimation_offset < parent_n_samp  # Sanity check (already enforced). Formula changes otherwise
-        return int(np.ceil((parent_n_samp - self._decimation_offset) / self._decimation_factor))
+        return self._num_samples
 
     def get_traces(self, start_frame, end_frame, channel_indices):
         if start_frame is None:
@@ -134,14 +230,79 @@ class DecimateRecordingSegment(BaseRecordingSegment):
         parent_start_frame = self._decimation_offset + start_frame * self._decimation_factor
         parent_end_frame = parent_start_frame + (end_frame - start_frame) * self._decimation_factor
 
-        # And now we can decimate without offsetting
-        return self._parent_segment.get_traces(
-            parent_start_frame,
-            parent_end_frame,
-            channel_indices,
-        )[
-            :: self._decimation_factor
-        ].astype(self._dtype)
+        if self._fir_coeff is not None:
+            return self._get_antialiased_traces(parent_start_frame, end_frame - start_frame, channel_indices)
+
+        # Read the parent by sub-windows holding a whole number of decimated frames, so that peak memory
+        # does not scale with decimation_factor * (end_frame - start_frame)
+        chunk_num_frames = max(1, self._parent_chunk_size // self._decimation_factor)
+        parent_chunk_size = chunk_num_frames * self._decimation_factor
+
+        if parent_end_frame - parent_start_frame <= parent_chunk_size:
+            # And now we can decimate without offsetting
+            parent_traces = self._parent_segment.get_traces(
+                parent_start_frame,
+                parent_end_frame,
+                channel_indices,
+            )
+            decimated_traces = parent_traces[:: self._decimation_factor]
+            # only cast when needed: a single copy of the strided view is enough
+            if self._dtype_matches_parent:
+                return np.asarray(decimated_traces, order=self._order)
+            return decimated_traces.astype(self._dtype, order=self._order, copy=False)
+
+        traces = None
+        for i, parent_chunk_start in enumerate(range(parent_start_frame, parent_end_frame, parent_chunk_size)):
+            parent_chunk_end = min(parent_chunk_start + parent_chunk_size, parent_end_frame)
+            decimated_chunk = self._parent_segment.get_traces(
+                parent_chunk_start,
+                parent_chunk_end,
+                channel_indices,
+            )[:: self._decimation_factor]
+            if traces is None:
+                traces = np.empty(
+                    (end_frame - start_frame, decimated_chunk.shape[1]), dtype=self._dtype, order=self._order
+                )
+            traces[i * chunk_num_frames : i * chunk_num_frames + decimated_chunk.shape[0]] = decimated_chunk
+        return traces
+
+    def _get_antialiased_traces(self, parent_start_frame, num_frames, channel_indices):
+        from scipy import signal
+
+        factor = self._decimation_factor
+        half_width = self._fir_coeff.size // 2
+        num_frames = max(num_frames, 0)
+        # The full convolution is centered on the first requested parent frame at index `margin + half_width`.
+        # Choose the smallest margin >= half_width making this index a multiple of the decimation factor, so that
+        # upfirdn (which keeps every `factor`-th sample of the convolution) returns the centered output directly.
+        margin = half_width + (-2 * half_width) % factor
+        first_frame = (margin + half_width) // factor
+
+        # Filter by sub-windows of the parent, each one read with its own margin
+        chunk_num_frames = max(1, self._parent_chunk_size // factor)
+        traces = None
+        for chunk_start in range(0, max(num_frames, 1), chunk_num_frames):
+            chunk_end = min(chunk_start + chunk_num_frames, num_frames)
+            parent_chunk_start = parent_start_frame + chunk_start * factor
+            parent_traces, _, _ = get_chunk_with_margin(
+                self._parent_segment,
+                parent_chunk_start,
+                parent_chunk_start + (chunk_end - chunk_start) * factor,
+                channel_indices,
+                margin,
+                add_zeros=True,
+                dtype=self._fir_coeff.dtype,
+            )
+            filtered_traces = signal.upfirdn(self._fir_coeff, parent_traces, up=1, down=factor, axis=0)
+            filtered_traces = filtered_traces[first_frame : first_frame + chunk_end - chunk_start]
+            if np.issubdtype(self._dtype, np.integer):
+                # ringing of the filter can exceed the range of the dtype
+                dtype_info = np.iinfo(self._dtype)
+                filtered_traces = np.clip(filtered_traces.round(), dtype_info.min, dtype_info.max)
+            if traces is None:
+                traces = np.empty((num_frames, filtered_traces.shape[1]), dtype=self._dtype, order=self._order)
+            traces[chunk_start:chunk_end] = filtered_traces
+        return traces
 
 
 decimate = define_function_from_class(source_class=DecimateRecording, name="decimate")
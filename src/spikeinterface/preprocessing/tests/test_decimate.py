@@ -4,7 +4,7 @@ from pathlib import Path
 import itertools
 from spikeinterface import NumpyRecording
 from spikeinterface.core import generate_recording
-from spikeinterface.preprocessing.decimate import DecimateRecording
+from spikeinterface.preprocessing.decimate import DecimateRecording, DecimateRecordingSegment
 import numpy as np
 
 
@@ -42,5 +42,193 @@ def test_decimate(N_segments, decimation_offset, decimation_factor, start_frame,
         )
 
 
+def test_decimate_arg_types():
+    rec = NumpyRecording([np.arange(2 * 101).reshape(101, 2)], 1)
+
+    decimated_rec = DecimateRecording(rec, np.int64(10), decimation_offset=np.int32(3))
+    assert np.array_equal(decimated_rec.get_traces(), rec.get_traces()[3::10])
+    assert type(decimated_rec._kwargs["decimation_factor"]) is int
+    assert type(decimated_rec._kwargs["decimation_offset"]) is int
+
+    for decimation_factor, decimation_offset in [(10.0, 0), (0, 0), (-2, 0), (10, 1.0), (10, -1)]:
+        with pytest.raises(ValueError):
+            DecimateRecording(rec, decimation_factor, decimation_offset=decimation_offset)
+
+
+def test_decimate_keeps_parent_time_vector():
+    rec = NumpyRecording([np.arange(2 * 101).reshape(101, 2)], 1000.0)
+    times = np.arange(101) / 1000.0 + 5.0
+    rec.set_times(times)
+
+    decimated_rec = DecimateRecording(rec, 10)
+    assert rec.has_time_vector()
+    assert np.array_equal(rec.get_times(), times)
+    assert not decimated_rec.has_time_vector()
+
+
+@pytest.mark.parametrize("inner_decimation", [(1, 0), (2, 1), (3, 0), (3, 2)])
+@pytest.mark.parametrize("outer_decimation", [(1, 0), (2, 1), (5, 3)])
+def test_decimate_chained(inner_decimation, outer_decimation):
+    rec = NumpyRecording([np.arange(2 * 1001).reshape(1001, 2)], 1000.0, t_starts=[10.0])
+
+    inner_factor, inner_offset = inner_decimation
+    outer_factor, outer_offset = outer_decimation
+    inner_rec = DecimateRecording(rec, inner_factor, decimation_offset=inner_offset)
+    inner_rec.set_property("quality", ["good", "bad"])
+    decimated_rec = DecimateRecording(inner_rec, outer_factor, decimation_offset=outer_offset)
+
+    # the chain is collapsed on the parent recording
+    assert decimated_rec._kwargs["recording"] is rec
+    expected_traces = rec.get_traces()[inner_offset::inner_factor][outer_offset::outer_factor]
+    assert decimated_rec.get_num_samples() == expected_traces.shape[0]
+    assert np.array_equal(decimated_rec.get_traces(), expected_traces)
+    assert np.array_equal(decimated_rec.get_traces(start_frame=2, end_frame=9), expected_traces[2:9])
+    assert np.isclose(decimated_rec.sampling_frequency, inner_rec.sampling_frequency / outer_factor)
+    assert np.isclose(decimated_rec.get_times()[0], inner_rec.get_times()[outer_offset])
+    assert list(decimated_rec.get_property("quality")) == ["good", "bad"]
+
+    # anti-aliased decimations are not collapsed
+    antialiased_rec = DecimateRecording(inner_rec, outer_factor, decimation_offset=outer_offset, antialias=True)
+    assert antialiased_rec._kwargs["recording"] is inner_rec
+
+    # neither are decimations casting the parent dtype
+    cast_rec = DecimateRecording(rec, inner_factor, decimation_offset=inner_offset, dtype="float32")
+    decimated_rec = DecimateRecording(cast_rec, outer_factor, decimation_offset=outer_offset)
+    assert decimated_rec._kwargs["recording"] is cast_rec
+    assert decimated_rec.get_dtype() == np.dtype("float32")
+
+
+def record_parent_read_sizes(monkeypatch, recording, segment_index=0):
+    """Record the number of frames of each get_traces() call on a recording segment"""
+    parent_segment = recording._recording_segments[segment_index]
+    parent_get_traces = parent_segment.get_traces
+    read_sizes = []
+
+    def get_traces_recorded(start_frame, end_frame, channel_indices):
+        read_sizes.append(end_frame - start_frame)
+        return parent_get_traces(start_frame, end_frame, channel_indices)
+
+    monkeypatch.setattr(parent_segment, "get_traces", get_traces_recorded)
+    return read_sizes
+
+
+@pytest.mark.parametrize("decimation_factor", [1, 3, 7, 40])
+def test_decimate_chunked_parent_reads(monkeypatch, decimation_factor):
+    rec = NumpyRecording([np.arange(2 * 1001).reshape(1001, 2)], 1)
+    decimated_rec = DecimateRecording(rec, decimation_factor, decimation_offset=decimation_factor // 2)
+    expected_traces = decimated_rec.get_traces()
+
+    # force several parent reads per get_traces() call
+    monkeypatch.setattr(DecimateRecordingSegment, "_parent_chunk_size", 50)
+    parent_read_sizes = record_parent_read_sizes(monkeypatch, rec)
+
+    max_parent_read_size = max(1, 50 // decimation_factor) * decimation_factor
+    for start_frame, end_frame in [(None, None), (1, 11), (3, None)]:
+        parent_read_sizes.clear()
+        traces = decimated_rec.get_traces(start_frame=start_frame, end_frame=end_frame)
+        assert traces.dtype == rec.get_dtype()
+        assert np.array_equal(traces, expected_traces[start_frame:end_frame])
+        assert len(parent_read_sizes) > 0
+        assert max(parent_read_sizes) <= max_parent_read_size
+
+
+@pytest.mark.parametrize("decimation_factor", [1, 2, 3, 10])
+@pytest.mark.parametrize("num_taps", [None, 5, 31])
+@pytest.mark.parametrize("parent_chunk_size", [50, 1 << 20])
+def test_decimate_antialias(monkeypatch, decimation_factor, num_taps, parent_chunk_size):
+    traces = np.random.default_rng(0).standard_normal((1000, 3)).astype("float32")
+    rec = NumpyRecording([traces], 1000.0)
+
+    monkeypatch.setattr(DecimateRecordingSegment, "_parent_chunk_size", parent_chunk_size)
+    parent_read_sizes = record_parent_read_sizes(monkeypatch, rec)
+
+    for decimation_offset in range(decimation_factor):
+        decimated_rec = DecimateRecording(
+            rec, decimation_factor, decimation_offset=decimation_offset, antialias=True, num_taps=num_taps
+        )
+        fir_coeff = decimated_rec._recording_segments[0]._fir_coeff
+        if decimation_factor == 1:
+            assert fir_coeff is None
+            expected_traces = traces
+        else:
+            expected_traces = np.stack(
+                [np.convolve(traces[:, c], fir_coeff, mode="same") for c in range(traces.shape[1])], axis=1
+            )
+        expected_traces = expected_traces[decimation_offset::decimation_factor]
+
+        assert decimated_rec.get_num_samples() == expected_traces.shape[0]
+        for start_frame, end_frame in [(None, None), (0, 5), (3, 40), (50, 1000)]:
+            parent_read_sizes.clear()
+            decimated_traces = decimated_rec.get_traces(start_frame=start_frame, end_frame=end_frame)
+            assert decimated_traces.dtype == np.dtype("float32")
+            assert np.allclose(decimated_traces, expected_traces[start_frame:end_frame], atol=1e-5)
+            if fir_coeff is not None:
+                # each parent read is bounded by the chunk size plus the filter margins
+                chunk_size = max(1, parent_chunk_size // decimation_factor) * decimation_factor
+                assert max(parent_read_sizes) <= chunk_size + fir_coeff.size + 2 * decimation_factor
+
+    for num_taps in [4, 9.0, 0, -3]:
+        with pytest.raises(ValueError):
+            DecimateRecording(rec, 2, antialias=True, num_taps=num_taps)
+
+
+def test_decimate_antialias_dtype():
+    # frames away from the zero-padded borders (default filter of 33 taps for a factor of 2)
+    inner = slice(10, -10)
+
+    # no filter is built for a factor of 1: the unsigned dtype is kept
+    traces = np.full((101, 2), 60000, dtype="uint16")
+    rec = NumpyRecording([traces], 1000.0)
+    decimated_rec = DecimateRecording(rec, 1, antialias=True)
+    assert decimated_rec.get_dtype() == np.dtype("uint16")
+    assert np.array_equal(decimated_rec.get_traces(), traces)
+
+    # integer recordings are filtered and returned as float32 by default, a constant keeps its level
+    decimated_rec = DecimateRecording(rec, 2, antialias=True)
+    assert decimated_rec.get_dtype() == np.dtype("float32")
+    assert np.allclose(decimated_rec.get_traces()[inner], 60000, rtol=1e-5)
+
+    # an integer dtype can be requested: traces are rounded
+    decimated_rec = DecimateRecording(rec, 2, antialias=True, dtype="uint16")
+    assert decimated_rec.get_dtype() == np.dtype("uint16")
+    assert np.all(decimated_rec.get_traces()[inner] == 60000)
+    rec_int16 = NumpyRecording([np.full((101, 2), 1000, dtype="int16")], 1000.0)
+    decimated_rec = DecimateRecording(rec_int16, 2, antialias=True, dtype="int16")
+    assert np.all(decimated_rec.get_traces()[inner] == 1000)
+
+    # full scale square wave: the ringing of the filter is clipped to the dtype range
+    traces = np.where(np.arange(1000) % 40 < 20, -32768, 32767).astype("int16")[:, None]
+    rec_int16 = NumpyRecording([traces], 1000.0)
+    float_traces = DecimateRecording(rec_int16, 2, antialias=True).get_traces()
+    assert float_traces.max() > 32767 and float_traces.min() < -32768
+    int_traces = DecimateRecording(rec_int16, 2, antialias=True, dtype="int16").get_traces()
+    assert np.array_equal(int_traces, np.clip(np.round(float_traces), -32768, 32767))
+
+    # float64 recordings are filtered in float64
+    traces = np.random.default_rng(0).standard_normal((1000, 2))
+    decimated_rec = DecimateRecording(NumpyRecording([traces], 1000.0), 2, antialias=True)
+    fir_coeff = decimated_rec._recording_segments[0]._fir_coeff
+    assert decimated_rec.get_dtype() == np.dtype("float64")
+    assert fir_coeff.dtype == np.dtype("float64")
+    expected_traces = np.stack([np.convolve(traces[:, c], fir_coeff, mode="same") for c in range(2)], axis=1)
+    assert np.allclose(decimated_rec.get_traces(), expected_traces[::2], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("antialias", [False, True])
+@pytest.mark.parametrize("parent_chunk_size", [50, 1 << 20])
+def test_decimate_channel_major(monkeypatch, antialias, parent_chunk_size):
+    rec = NumpyRecording([np.arange(3 * 1001, dtype="float32").reshape(1001, 3)], 1)
+    monkeypatch.setattr(DecimateRecordingSegment, "_parent_chunk_size", parent_chunk_size)
+
+    decimated_rec = DecimateRecording(rec, 3, antialias=antialias)
+    decimated_rec_f = DecimateRecording(rec, 3, antialias=antialias, channel_major=True)
+    for start_frame, end_frame in [(None, None), (1, 11)]:
+        traces = decimated_rec.get_traces(start_frame=start_frame, end_frame=end_frame)
+        traces_f = decimated_rec_f.get_traces(start_frame=start_frame, end_frame=end_frame)
+        assert traces.flags.c_contiguous
+        assert traces_f.flags.f_contiguous
+        assert np.array_equal(traces, traces_f)
+
+
 if __name__ == "__main__":
     test_decimate()